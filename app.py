@@ -1,54 +1,129 @@
 import streamlit as st
-from pypdf import PdfReader
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import gspread
 from google.oauth2.service_account import Credentials
+from google.auth.exceptions import GoogleAuthError
 from st_click_detector import click_detector
 import html
 import re
 import json
 import os
+import time
+import threading
+import itertools
+import hashlib
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import msgpack
+import requests
+import openai
 from openai import OpenAI
+from pdf_backend import extract_page_texts
 
 # --- ページ設定 ---
 st.set_page_config(layout="wide", page_title="AI Book Reader", initial_sidebar_state="collapsed")
 
+# --- 設定: ローカルキャッシュ ---
+CACHE_DIR = os.path.join("books", ".cache")
+
 # --- 設定: Google Sheets連携 ---
 scope = [
     "https://www.googleapis.com/auth/spreadsheets",
     "https://www.googleapis.com/auth/drive"
 ]
 
+# 認証済みクライアントは再実行をまたいで使い回す (失敗時は例外なのでキャッシュされない)
+@st.cache_resource(show_spinner=False)
+def _authorize_gspread():
+    creds_dict = dict(st.secrets["gcp_service_account"])
+    creds = Credentials.from_service_account_info(creds_dict, scopes=scope)
+    # 429 / 5xx は指数バックオフで自動再試行する
+    return gspread.authorize(creds, http_client=gspread.BackOffHTTPClient)
+
 def get_gspread_client():
     try:
-        creds_dict = dict(st.secrets["gcp_service_account"])
-        creds = Credentials.from_service_account_info(creds_dict, scopes=scope)
-        client = gspread.authorize(creds)
-        return client
+        return _authorize_gspread()
     except Exception as e:
         st.error(f"Google Auth Error: {e}")
         return None
 
+# Sheets 呼び出しで握りつぶしてよいエラー (それ以外はバグとして表に出す)
+# トークン更新の失敗 (RefreshError / TransportError) は GoogleAuthError として飛んでくる
+SHEETS_ERRORS = (gspread.exceptions.GSpreadException, requests.exceptions.RequestException, GoogleAuthError)
+
+# スプレッドシートを開く (Drive のメタデータ取得) のも1回だけにする。
+# ワーカースレッドからも呼ばれるので、失敗は st.error を出さずに例外で返す
+@st.cache_resource(show_spinner=False)
+def get_spreadsheet():
+    return _authorize_gspread().open(st.secrets["sheet_config"]["sheet_name"])
+
 # --- 💾 進捗保存・読み込み機能 ---
+@st.cache_resource(show_spinner=False)
+def _open_progress_worksheet():
+    sheet = get_spreadsheet()
+    try:
+        worksheet = sheet.worksheet("Progress")
+    except gspread.exceptions.WorksheetNotFound:
+        worksheet = sheet.add_worksheet(title="Progress", rows=10, cols=2)
+        worksheet.update('A1', [['LastBook', 'Page']])
+    return worksheet
+
 def get_progress_sheet():
-    client = get_gspread_client()
-    if not client: return None
+    # 認証エラーはここ (スクリプトのスレッド) で表示する
+    if not get_gspread_client():
+        return None
     try:
-        sheet = client.open(st.secrets["sheet_config"]["sheet_name"])
-        try:
-            worksheet = sheet.worksheet("Progress")
-        except:
-            worksheet = sheet.add_worksheet(title="Progress", rows=10, cols=2)
-            worksheet.update('A1', [['LastBook', 'Page']]) 
-        return worksheet
-    except Exception as e:
+        return _open_progress_worksheet()
+    except Exception:
         return None
 
-def save_progress(filename, page_index):
+# ローカルファイルへ即時保存し、Sheets へは PROGRESS_SYNC_DELAY 秒まとめてから非同期で送る
+PROGRESS_FILE = os.path.join("books", ".progress.json")
+PROGRESS_SYNC_DELAY = 2.0
+
+def _write_local_progress(filename, page_index):
+    try:
+        with open(PROGRESS_FILE, "w") as f:
+            json.dump({"book": filename, "page": page_index}, f)
+    except OSError: pass
+
+def _read_local_progress():
+    try:
+        with open(PROGRESS_FILE) as f:
+            data = json.load(f)
+        return data.get("book") or None, int(data.get("page", 0))
+    except (OSError, ValueError, AttributeError):
+        return None, 0
+
+@st.cache_resource(show_spinner=False)
+def _progress_sync_state():
+    return {"lock": threading.Lock(), "latest": None, "timer": None}
+
+def _sync_progress_to_sheet(ws, state):
+    with state["lock"]:
+        row, state["latest"], state["timer"] = state["latest"], None, None
+    try:
+        ws.update('A2:B2', [row])
+    except SHEETS_ERRORS: pass
+
+def _schedule_progress_sync(row):
     ws = get_progress_sheet()
-    if ws:
-        try:
-            ws.update('A2:B2', [[filename, str(page_index)]])
-        except: pass
+    if not ws: return
+    state = _progress_sync_state()
+    with state["lock"]:
+        state["latest"] = row
+        if state["timer"] is None:
+            timer = threading.Timer(PROGRESS_SYNC_DELAY, _sync_progress_to_sheet, args=(ws, state))
+            timer.daemon = True
+            state["timer"] = timer
+            timer.start()
+
+def save_progress(filename, page_index):
+    if st.session_state.get("last_saved_progress") == (filename, page_index): return
+    st.session_state.last_saved_progress = (filename, page_index)
+    _write_local_progress(filename, page_index)
+    _schedule_progress_sync([filename, str(page_index)])
 
 def load_progress():
     ws = get_progress_sheet()
@@ -57,111 +132,423 @@ def load_progress():
             data = ws.get('A2:B2')
             if data and len(data) > 0 and len(data[0]) >= 2:
                 return data[0][0], int(data[0][1])
-        except: pass
-    return None, 0
+        except (*SHEETS_ERRORS, ValueError): pass
+    return _read_local_progress()
 
 def clear_progress():
-    ws = get_progress_sheet()
-    if ws:
-        try:
-            ws.update('A2:B2', [['', '']])
-        except: pass
+    st.session_state.last_saved_progress = None
+    _write_local_progress("", 0)
+    _schedule_progress_sync(['', ''])
+
+# --- 📝 単語帳シートへの書き込み (append_rows でまとめて送信) ---
+# PENDING_ROWS_FLUSH_SIZE 行溜まるか、最古の行が PENDING_ROWS_MAX_AGE_SEC 秒待ったら送る
+PENDING_ROWS_FLUSH_SIZE = 10
+PENDING_ROWS_MAX_AGE_SEC = 30
+ROW_FLUSH_CHECK_SEC = 5
+# 送信に失敗し続けても (Sheets 未設定など) これ以上は溜めない。超えた分は古い行から捨てる
+PENDING_ROWS_MAX = 200
+
+@st.cache_resource(show_spinner=False)
+def get_vocab_worksheet():
+    return get_spreadsheet().sheet1
+
+# ワーカースレッドで実行される
+def _append_rows(rows):
+    get_vocab_worksheet().append_rows(rows, value_input_option="RAW")
+
+# 完了した送信を回収する。wait=True なら全て終わるまで待つ
+def _reap_row_flushes(wait=False):
+    failed = []
+    try:
+        for entry in list(st.session_state.row_flushes):
+            future, sent_rows = entry
+            if not wait and not future.done():
+                continue
+            # 想定外の例外でも同じ future を毎回拾い直さないよう、先に一覧から外す
+            st.session_state.row_flushes.remove(entry)
+            try:
+                future.result()
+                st.session_state.sheets_error = None
+            except (*SHEETS_ERRORS, KeyError, ValueError, OSError) as e:
+                # 認証・設定の失敗も含め、ワーカーではなくここで記録して画面に出す
+                failed.extend(sent_rows)
+                st.session_state.sheets_error = f"{type(e).__name__}: {e}"
+    finally:
+        # 失敗した行は元の順番で先頭に戻し、次回の flush で再送する
+        st.session_state.pending_rows = (failed + st.session_state.pending_rows)[-PENDING_ROWS_MAX:]
+        # 失敗直後は自動送信を控え、PENDING_ROWS_MAX_AGE_SEC 後に再試行する
+        if failed:
+            st.session_state.row_flush_retry_at = time.time() + PENDING_ROWS_MAX_AGE_SEC
+
+# 送信はバックグラウンドで行い、クリック処理を待たせない。wait=True なら完了まで待つ
+def flush_pending_rows(wait=False):
+    rows = st.session_state.pending_rows
+    if rows:
+        st.session_state.pending_rows = []
+        st.session_state.row_flushes.append((submit_with_ctx(_append_rows, rows), rows))
+    _reap_row_flushes(wait)
+
+# 件数か待ち時間の条件を満たしたときだけ送る (1クリックごとに書き込まない)
+def flush_due_rows():
+    _reap_row_flushes()
+    rows = st.session_state.pending_rows
+    now = time.time()
+    if not rows or now < st.session_state.row_flush_retry_at:
+        return
+    if len(rows) >= PENDING_ROWS_FLUSH_SIZE or now - st.session_state.pending_rows_since >= PENDING_ROWS_MAX_AGE_SEC:
+        flush_pending_rows()
+
+@st.fragment(run_every=ROW_FLUSH_CHECK_SEC)
+def row_flusher():
+    flush_due_rows()
 
 # --- 設定: OpenAI ---
-def analyze_chunk_with_gpt(target_word, context_text):
-    client = OpenAI(api_key=st.secrets["openai"]["api_key"])
+OPENAI_TIMEOUT = 20
+OPENAI_MAX_RETRIES = 3
+
+@st.cache_resource(show_spinner=False)
+def get_openai_client():
+    return OpenAI(api_key=st.secrets["openai"]["api_key"], timeout=OPENAI_TIMEOUT, max_retries=OPENAI_MAX_RETRIES)
+
+# 事前スロットリング: 直近60秒の送信数が上限に達していたら空くまで待つ (全セッション共有)
+OPENAI_REQUESTS_PER_MIN = 60
+
+@st.cache_resource(show_spinner=False)
+def _openai_rate_state():
+    return {"lock": threading.Lock(), "sent": deque()}
+
+def throttle_openai():
+    state = _openai_rate_state()
+    while True:
+        with state["lock"]:
+            now = time.monotonic()
+            sent = state["sent"]
+            while sent and now - sent[0] >= 60:
+                sent.popleft()
+            if len(sent) < OPENAI_REQUESTS_PER_MIN:
+                sent.append(now)
+                return
+            wait = 60 - (now - sent[0])
+        time.sleep(wait)
+
+def _lookup_error(target_word):
+    return {"chunk": target_word, "pronunciation": "", "meaning": "Error", "pos": "-", "original_sentence": ""}
+
+# 複数の単語を1回のリクエストでまとめて解析する (結果は入力と同じ順番)
+def analyze_chunks_with_gpt(target_words, context_text):
+    client = get_openai_client()
     
-    prompt = f"""
-    The user is reading: "{context_text}"
-    Target word: "{target_word}"
-
-    Task:
-    1. Identify the core word or idiom (Keep it short).
-    2. IPA pronunciation (e.g. /wɜːrd/).
-    3. Japanese meaning (Concise).
-    4. Extract the ONE specific sentence containing the target word.
-
-    Output JSON keys: "chunk", "pronunciation", "meaning", "pos", "original_sentence"
-    """
+    # 指示は最小限に: インデントや番号付きの手順は入力トークンを増やすだけ
+    prompt = (
+        f'Text: "{context_text}"\n'
+        f"Words: {json.dumps(target_words, ensure_ascii=False)}\n"
+        'Return JSON {"results": [...]} with one object per word, in order, with keys: '
+        '"chunk" (the short word or idiom), "pronunciation" (IPA), "meaning" (concise Japanese), '
+        '"pos", "original_sentence" (the one sentence in Text containing the word).'
+    )
+    throttle_openai()
     try:
         response = client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
-            response_format={"type": "json_object"}
+            response_format={"type": "json_object"},
+            max_tokens=256 * len(target_words)
         )
-        return json.loads(response.choices[0].message.content)
-    except:
-        return {"chunk": target_word, "pronunciation": "", "meaning": "Error", "pos": "-", "original_sentence": ""}
+        results = json.loads(response.choices[0].message.content).get("results", [])
+    except (openai.APIError, json.JSONDecodeError, AttributeError):
+        results = []
+    # 取得できなかった単語は None (キャッシュしない)
+    return [
+        results[i] if i < len(results) and isinstance(results[i], dict) else None
+        for i in range(len(target_words))
+    ]
+
+# --- 🗃️ 検索結果キャッシュ (SQLite: 同じ画面の同じ単語は再問い合わせしない) ---
+LOOKUP_DB_PATH = os.path.join(CACHE_DIR, "lookups.sqlite")
+
+def context_key(context_text):
+    return hashlib.sha1(context_text.encode()).hexdigest()[:16]
+
+# 接続はスレッドごとに1回だけ開いて使い回す (sqlite3 の接続はスレッドをまたげない)
+@st.cache_resource(show_spinner=False)
+def _lookup_db_local():
+    return threading.local()
+
+def _lookup_db():
+    local = _lookup_db_local()
+    if getattr(local, "conn", None) is None:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        conn = sqlite3.connect(LOOKUP_DB_PATH)
+        conn.execute("CREATE TABLE IF NOT EXISTS lookups (word TEXT, context TEXT, result TEXT, PRIMARY KEY (word, context))")
+        local.conn = conn
+    return local.conn
+
+def get_cached_lookups(word_keys, ctx_key):
+    try:
+        rows = _lookup_db().execute(
+            f"SELECT word, result FROM lookups WHERE context = ? AND word IN ({','.join('?' * len(word_keys))})",
+            [ctx_key, *word_keys]
+        ).fetchall()
+        return {word: json.loads(result) for word, result in rows}
+    except (sqlite3.Error, OSError):
+        return {}
+
+def put_cached_lookups(results_by_word, ctx_key):
+    if not results_by_word: return
+    try:
+        conn = _lookup_db()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO lookups (word, context, result) VALUES (?, ?, ?)",
+                [(word, ctx_key, json.dumps(result, ensure_ascii=False)) for word, result in results_by_word.items()]
+            )
+    except (sqlite3.Error, OSError):
+        pass
+
+# --- ✂️ 問い合わせに使う文脈の切り出し ---
+CONTEXT_WINDOW_CHARS = 2000
+CONTEXT_WINDOW_STRIDE = 500
+
+# クリックした単語 (context_text 内の文字位置 pos) の周辺 CONTEXT_WINDOW_CHARS 文字だけを送る。
+# 窓の開始位置を STRIDE 単位に揃え、近くの単語同士は同じ文脈 (=同じバッチ・同じキャッシュキー) になるようにする
+def clip_context(context_text, pos):
+    if len(context_text) <= CONTEXT_WINDOW_CHARS:
+        return context_text
+    start = max(0, pos - CONTEXT_WINDOW_CHARS // 2) // CONTEXT_WINDOW_STRIDE * CONTEXT_WINDOW_STRIDE
+    start = min(start, len(context_text) - CONTEXT_WINDOW_CHARS)
+    return context_text[start:start + CONTEXT_WINDOW_CHARS]
+
+# --- 🔎 単語検索キュー (連続クリックをまとめ、バックグラウンドで問い合わせる) ---
+LOOKUP_BATCH_SIZE = 3
+LOOKUP_DEBOUNCE_SEC = 0.3
+LOOKUP_PLACEHOLDER = {"meaning": "…", "pos": "?", "pronunciation": ""}
+
+# ワーカースレッドで実行される: session_state には触らない
+def resolve_lookups(words, context_text):
+    ctx_key = context_key(context_text)
+    found = get_cached_lookups([w.lower() for w in words], ctx_key)
+    # 同じ単語 (大文字小文字違いを含む) は1回だけ問い合わせる
+    misses = list({w.lower(): w for w in words if w.lower() not in found}.values())
+    if misses:
+        fresh = {
+            w.lower(): result
+            for w, result in zip(misses, analyze_chunks_with_gpt(misses, context_text))
+            if result is not None
+        }
+        put_cached_lookups(fresh, ctx_key)
+        found.update(fresh)
+    return [found.get(w.lower()) for w in words]
+
+# クリック直後はプレースホルダーを表示し、結果が届いたら差し替える
+def queue_lookup(target_word, context_text):
+    st.session_state.lookup_seq += 1
+    slot_id = st.session_state.lookup_seq
+    st.session_state.slots.appendleft({"chunk": target_word, "info": LOOKUP_PLACEHOLDER, "id": slot_id})
+    st.session_state.pending_words.append({"id": slot_id, "word": target_word, "context": context_text})
+    st.session_state.lookup_requested_at = time.time()
+    if len(st.session_state.pending_words) >= LOOKUP_BATCH_SIZE:
+        dispatch_pending_words()
+
+def dispatch_pending_words():
+    pending = st.session_state.pending_words
+    st.session_state.pending_words = []
+    by_context = {}
+    for item in pending:
+        by_context.setdefault(item["context"], []).append(item)
+    for context_text, items in by_context.items():
+        future = submit_with_ctx(resolve_lookups, [item["word"] for item in items], context_text)
+        st.session_state.lookup_futures.append((future, items))
+
+def store_lookup_result(item, result):
+    target_word = item["word"]
+    if result is None:
+        result = _lookup_error(target_word)
+    meaning_full = f"{result.get('meaning', '')} ({result.get('pos', '')})"
+    if not st.session_state.pending_rows:
+        st.session_state.pending_rows_since = time.time()
+    st.session_state.pending_rows.append([
+        result.get('chunk', target_word),
+        result.get('pronunciation', ''),
+        meaning_full,
+        result.get('original_sentence', ''),
+        st.session_state.pdf_filename
+    ])
+    
+    # プレースホルダーがまだ表示されていれば差し替える (押し出し済みなら記録のみ)
+    slots = st.session_state.slots
+    for i, slot in enumerate(slots):
+        if slot is not None and slot.get("id") == item["id"]:
+            slots[i] = {"chunk": result.get("chunk", target_word), "info": result}
+            break
+
+# 完了した問い合わせを反映する。wait=True なら全て終わるまで待つ
+def collect_lookup_results(wait=False):
+    remaining = []
+    collected = False
+    for future, items in st.session_state.lookup_futures:
+        if not wait and not future.done():
+            remaining.append((future, items))
+            continue
+        try:
+            results = future.result()
+        except Exception:
+            results = [None] * len(items)
+        for item, result in zip(items, results):
+            store_lookup_result(item, result)
+        collected = True
+    st.session_state.lookup_futures = remaining
+    if collected:
+        flush_due_rows()
+    return collected
+
+# 最後のクリックから LOOKUP_DEBOUNCE_SEC 経過したら送信し、完了した結果を拾って再描画する
+@st.fragment(run_every=LOOKUP_DEBOUNCE_SEC)
+def lookup_worker():
+    if st.session_state.pending_words and time.time() - st.session_state.lookup_requested_at >= LOOKUP_DEBOUNCE_SEC:
+        dispatch_pending_words()
+    if collect_lookup_results():
+        st.rerun()
 
 # --- テキスト構造解析 ---
-def parse_pdf_to_structured_blocks(text):
-    if not text: return []
-    lines = text.splitlines()
-    blocks = []
-    current_text = ""
-    current_type = "p"
+# 解析ロジックを変えたら上げる (ディスクキャッシュの無効化用)
+SCREENS_CACHE_VERSION = 8
+
+# 見出し・箇条書きを1回の match で判定する (両方に当たる行は見出しを優先)
+LINE_KIND_RE = re.compile(r'(?P<h>Chapter|Section|\d+\s+[A-Z])|(?P<li>[•·\-\*]|\d+\.)', re.IGNORECASE)
+SHOUT_HEADER_MAX_LEN = 120
+
+# 行のイテレータを受け取り、(type, text) を逐次 yield する (文書全体を1つの文字列にしない)
+def parse_pdf_to_structured_blocks(lines):
+    # 段落は行のリストに溜めて、出力時に一度だけ join する (+= による再コピーを避ける)
+    paragraph = []
     for line in lines:
         line = line.strip()
         if not line: continue
         
-        is_bullet = re.match(r'^([•·\-\*]|\d+\.)', line)
-        clean_line = line.replace('"', '').replace("'", "").strip()
-        is_explicit_header = re.match(r'^(Chapter|Section|\d+\s+[A-Z])', line, re.IGNORECASE)
-        is_shout_header = clean_line.isupper() and len(clean_line) >= 4
-        is_header = is_explicit_header or is_shout_header
+        kind = LINE_KIND_RE.match(line)
+        kind = kind.lastgroup if kind else None
+        is_header = kind == "h"
+        is_bullet = kind == "li"
+        # 長い行は見出しではないので isupper の全走査を省く
+        if not is_header and len(line) < SHOUT_HEADER_MAX_LEN:
+            clean_line = line.replace('"', '').replace("'", "").strip()
+            is_header = clean_line.isupper() and len(clean_line) >= 4
         
         if is_header or is_bullet:
-            if current_text:
-                blocks.append({"type": current_type, "text": current_text})
-                current_text = ""
+            if paragraph:
+                yield "p", " ".join(paragraph)
+                paragraph = []
             if is_header:
-                blocks.append({"type": "h", "text": line})
+                yield "h", line
             else:
-                blocks.append({"type": "li", "text": line})
+                yield "li", line
+        elif paragraph and paragraph[-1].endswith("-"):
+            paragraph[-1] = paragraph[-1][:-1] + line
         else:
-            if current_text:
-                if current_text.endswith("-"):
-                    current_text = current_text[:-1] + line
-                else:
-                    current_text += " " + line
-            else:
-                current_text = line
-                current_type = "p"
-    if current_text:
-        blocks.append({"type": current_type, "text": current_text})
-    return blocks
+            paragraph.append(line)
+    if paragraph:
+        yield "p", " ".join(paragraph)
 
+# 画面は SoA 形式 {"types": [...], "texts": [...], "context_text": str, "body_html": str, "words": [...], "offsets": [...]} で持つ
 def group_blocks_into_screens(blocks, words_per_screen=500):
-    screens = []
-    current_screen = []
+    types, texts = [], []
     current_word_count = 0
-    for block in blocks:
-        block_word_count = len(block["text"].split())
+    for b_type, text in blocks:
+        # 単語数は空白の数で数える (split でリストを作らない)
+        block_word_count = text.count(" ") + 1
         if current_word_count + block_word_count > words_per_screen and current_word_count > 100:
-            screens.append(current_screen)
-            current_screen = []
+            yield {"types": types, "texts": texts, "context_text": " ".join(texts)}
+            types, texts = [], []
             current_word_count = 0
-        current_screen.append(block)
+        types.append(b_type)
+        texts.append(text)
         current_word_count += block_word_count
-    if current_screen:
-        screens.append(current_screen)
+    if texts:
+        yield {"types": types, "texts": texts, "context_text": " ".join(texts)}
+
+# 単語の前後から取り除く記号
+WORD_PUNCT = ".,!?\"'()[]{}:;"
+
+WORD_TOKEN_RE = re.compile(r"\S+")
+
+# 画面本文のHTML (クリック用の <a> を含む) は解析時に一度だけ作り、画面と一緒にキャッシュする。
+# <a> の id は連番 (w0, w1, ...) のみとし、対応する単語は words リストで引く。
+# offsets には各単語の context_text (= " ".join(texts)) 内の文字位置を入れる (文脈の切り出し用)
+def render_screen_body(types, texts):
+    escape = html.escape
+    parts = []
+    append = parts.append
+    words, offsets = [], []
+    word_counter = 0
+    block_start = 0
+    for b_type, text in zip(types, texts):
+        base = block_start
+        block_start += len(text) + 1
+        if b_type == "h":
+            append(f"<div class='header-text'>{escape(text)}</div>")
+            continue
+        elif b_type == "li":
+            append("<div class='list-item'>")
+        else:
+            append("<div class='p-text'>")
+        for m in WORD_TOKEN_RE.finditer(text):
+            w = m.group()
+            clean_w = w.strip(WORD_PUNCT)
+            if not clean_w:
+                append(escape(w) + " ")
+                continue
+            append(f"<a href='#' id='w{word_counter}' class='w'>{escape(w)}</a> ")
+            words.append(clean_w)
+            offsets.append(base + m.start())
+            word_counter += 1
+        append("</div>")
+    return "".join(parts), words, offsets
+
+# --- 📦 解析結果キャッシュ (再実行・再起動をまたいで再利用) ---
+@st.cache_data(show_spinner=False)
+def build_screens(pdf_bytes, words_per_screen=500):
+    cache_path = os.path.join(CACHE_DIR, f"{hashlib.sha1(pdf_bytes).hexdigest()}_{words_per_screen}_v{SCREENS_CACHE_VERSION}.msgpack")
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, "rb") as f:
+                return msgpack.unpackb(f.read(), raw=False)
+        except (OSError, ValueError, msgpack.UnpackException):
+            pass
+    page_texts = extract_page_texts(pdf_bytes)
+    lines = itertools.chain.from_iterable(text.splitlines() for text in page_texts)
+    structured_blocks = parse_pdf_to_structured_blocks(lines)
+    screens = list(group_blocks_into_screens(structured_blocks, words_per_screen=words_per_screen))
+    for screen in screens:
+        screen["body_html"], screen["words"], screen["offsets"] = render_screen_body(screen["types"], screen["texts"])
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(cache_path, "wb") as f:
+            f.write(msgpack.packb(screens))
+    except OSError:
+        pass
     return screens
 
 # --- セッション初期化 ---
-if "last_clicked" not in st.session_state:
-    st.session_state.last_clicked = ""
-if "slots" not in st.session_state:
-    st.session_state.slots = [None] * 9
-if "reader_mode" not in st.session_state:
-    st.session_state.reader_mode = False
-if "all_screens" not in st.session_state:
-    st.session_state.all_screens = []
-if "current_screen_index" not in st.session_state:
-    st.session_state.current_screen_index = 0
-if "pdf_filename" not in st.session_state:
-    st.session_state.pdf_filename = ""
-if "initialized" not in st.session_state:
-    st.session_state.initialized = False
+SESSION_DEFAULTS = {
+    "last_clicked": "",
+    "slots": deque([None] * 9, maxlen=9),
+    "reader_mode": False,
+    "all_screens": [],
+    "current_screen_index": 0,
+    "pdf_filename": "",
+    "initialized": False,
+    "pending_rows": [],
+    "pending_rows_since": 0.0,
+    "row_flush_retry_at": 0.0,
+    "sheets_error": None,
+    "row_flushes": [],
+    "pending_words": [],
+    "lookup_requested_at": 0.0,
+    "lookup_futures": [],
+    "lookup_seq": 0,
+}
+for key, value in SESSION_DEFAULTS.items():
+    st.session_state.setdefault(key, value)
 
 # --- CSS ---
 st.markdown("""
@@ -221,17 +608,102 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# --- 読書エリア用 HTML ヘッダ (click_detector の iframe 内に埋め込む) ---
+# iframe には親ページの CSS が届かないので毎回同梱する。送信量を減らすため空白を詰めておく
+READER_HTML_HEAD = re.sub(r"\s+", " ", """
+<style>
+    .book-container {
+        background-color: #fff; border: 1px solid #ddd; border-radius: 4px;
+        padding: 30px 40px; font-family: 'Georgia', serif; font-size: 19px; line-height: 1.7; color: #2c3e50;
+        height: 92vh; overflow-y: auto;
+    }
+    .header-text { font-weight: bold; font-size: 1.4em; margin: 10px 0 15px 0; border-bottom: 2px solid #f0f0f0; }
+    .list-item { margin-left: 20px; margin-bottom: 5px; border-left: 3px solid #eee; padding-left: 10px; }
+    .p-text { margin-bottom: 20px; text-align: justify; }
+    .w { text-decoration: none; color: #2c3e50; cursor: pointer; border-bottom: 1px dotted #ccc; }
+    .w:hover { color: #d35400; border-bottom: 2px solid #d35400; background-color: #fff3e0; }
+    @media only screen and (max-width: 768px) {
+        .book-container { height: 92vh !important; padding: 15px !important; font-size: 16px !important; }
+    }
+</style>
+<div class='book-container'>
+""").strip()
+
+# --- 🧵 バックグラウンド処理用スレッドプール (全セッション共有) ---
+@st.cache_resource(show_spinner=False)
+def get_executor():
+    return ThreadPoolExecutor(max_workers=4)
+
+# 呼び出し元セッションの ScriptRunContext を引き継いで実行する (st.cache_* を安全に使うため)
+def submit_with_ctx(fn, *args):
+    ctx = get_script_run_ctx()
+    def _run():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*args)
+    return get_executor().submit(_run)
+
+# --- 📖 読書エリア + 辞書リスト (単語クリック時はこの部分だけ再実行する) ---
+@st.fragment
+def reader_area():
+    col_read, col_dict = st.columns([4.5, 1])
+    clicked = None
+
+    # --- 左: 読書エリア ---
+    with col_read:
+        if st.session_state.all_screens:
+            current_screen = st.session_state.all_screens[st.session_state.current_screen_index]
+            html_content = READER_HTML_HEAD + current_screen["body_html"] + "</div>"
+            clicked = click_detector(html_content, key=f"det_{st.session_state.current_screen_index}")
+
+    # id は画面ごとに同じ連番なので、画面番号と組にして重複クリックを判定する
+    click_key = f"{st.session_state.current_screen_index}:{clicked}"
+    if clicked and click_key != st.session_state.last_clicked:
+        st.session_state.last_clicked = click_key
+        word_index = int(clicked[1:]) if clicked[1:].isdigit() else -1
+        current_screen = st.session_state.all_screens[st.session_state.current_screen_index]
+        if 0 <= word_index < len(current_screen["words"]):
+            target_word = current_screen["words"][word_index]
+            context_text = clip_context(current_screen["context_text"], current_screen["offsets"][word_index])
+            # プレースホルダーは下の辞書リストにそのまま描かれる。
+            # lookup_worker が動いていなければアプリ全体を再実行して起動させる
+            worker_idle = not (st.session_state.pending_words or st.session_state.lookup_futures)
+            queue_lookup(target_word, context_text)
+            if worker_idle:
+                st.rerun()
+
+    # --- 右: 辞書リスト (クリック処理の後に描くので再実行しなくても新しいスロットが出る) ---
+    with col_dict:
+        for i in range(9):
+            slot_data = st.session_state.slots[i] if i < len(st.session_state.slots) else None
+        
+            if slot_data is None:
+                st.markdown(f"<div style='height: 60px; margin-bottom: 4px; border: 1px dashed #f0f0f0; border-radius: 4px;'></div>", unsafe_allow_html=True)
+            else:
+                chunk = slot_data['chunk']
+                info = slot_data['info']
+                st.markdown(f"""
+                <div class="dict-card">
+                    <div class="dict-header">
+                        <span class="dict-word">{chunk}</span>
+                        <span class="dict-pos">{info.get('pos')}</span>
+                    </div>
+                    <div class="dict-pron">{info.get('pronunciation', '')}</div>
+                    <div class="dict-meaning">{info.get('meaning')}</div>
+                </div>
+                """, unsafe_allow_html=True)
+
 # ==========================================
 # 0. 自動読み込みロジック
 # ==========================================
 def load_pdf(file_source, filename, start_page=0):
     with st.spinner(f"Opening {filename}..."):
-        reader = PdfReader(file_source)
-        full_text = ""
-        for page in reader.pages:
-            full_text += page.extract_text() + "\n"
-        structured_blocks = parse_pdf_to_structured_blocks(full_text)
-        st.session_state.all_screens = group_blocks_into_screens(structured_blocks, words_per_screen=500)
+        # バイト列を一度だけ読み、キャッシュキーにする
+        if isinstance(file_source, str):
+            with open(file_source, "rb") as f:
+                pdf_bytes = f.read()
+        else:
+            pdf_bytes = file_source.getvalue()
+        st.session_state.all_screens = build_screens(pdf_bytes, words_per_screen=500)
         
         if start_page < len(st.session_state.all_screens):
             st.session_state.current_screen_index = start_page
@@ -302,121 +774,37 @@ else:
                 if st.session_state.current_screen_index > 0:
                     st.session_state.current_screen_index -= 1
                     save_progress(st.session_state.pdf_filename, st.session_state.current_screen_index)
+                    flush_pending_rows()
                     st.rerun()
         with c2:
             if st.button("▶", key="next"):
                 if st.session_state.current_screen_index < len(st.session_state.all_screens) - 1:
                     st.session_state.current_screen_index += 1
                     save_progress(st.session_state.pdf_filename, st.session_state.current_screen_index)
+                    flush_pending_rows()
                     st.rerun()
         with c3:
             curr = st.session_state.current_screen_index + 1
             total = len(st.session_state.all_screens)
             fname = st.session_state.pdf_filename
-            st.markdown(f"<span style='color:#999; font-size:0.8em; margin-left:10px;'>Page {curr}/{total} | {fname}</span>", unsafe_allow_html=True)
+            status = f"Page {curr}/{total} | {fname}"
+            if st.session_state.sheets_error:
+                status += f" | <span style='color:#c0392b;'>⚠ 単語帳に保存できません ({html.escape(st.session_state.sheets_error[:80])})</span>"
+            st.markdown(f"<span style='color:#999; font-size:0.8em; margin-left:10px;'>{status}</span>", unsafe_allow_html=True)
         with c4:
              if st.button("✕", key="close"):
+                dispatch_pending_words()
+                collect_lookup_results(wait=True)
+                flush_pending_rows(wait=True)
                 clear_progress()
                 st.session_state.reader_mode = False
-                st.session_state.slots = [None] * 9
+                st.session_state.slots = deque([None] * 9, maxlen=9)
                 st.rerun()
 
-    col_read, col_dict = st.columns([4.5, 1])
-
-    # --- 左: 読書エリア ---
-    with col_read:
-        if st.session_state.all_screens:
-            current_blocks = st.session_state.all_screens[st.session_state.current_screen_index]
-            html_content = """
-            <style>
-                .book-container {
-                    background-color: #fff; border: 1px solid #ddd; border-radius: 4px;
-                    padding: 30px 40px; font-family: 'Georgia', serif; font-size: 19px; line-height: 1.7; color: #2c3e50;
-                    height: 92vh; overflow-y: auto;
-                }
-                .header-text { font-weight: bold; font-size: 1.4em; margin: 10px 0 15px 0; border-bottom: 2px solid #f0f0f0; }
-                .list-item { margin-left: 20px; margin-bottom: 5px; border-left: 3px solid #eee; padding-left: 10px; }
-                .p-text { margin-bottom: 20px; text-align: justify; }
-                .w { text-decoration: none; color: #2c3e50; cursor: pointer; border-bottom: 1px dotted #ccc; }
-                .w:hover { color: #d35400; border-bottom: 2px solid #d35400; background-color: #fff3e0; }
-                @media only screen and (max-width: 768px) {
-                    .book-container { height: 92vh !important; padding: 15px !important; font-size: 16px !important; }
-                }
-            </style>
-            <div class='book-container'>
-            """
-            word_counter = 0
-            for block in current_blocks:
-                b_type = block["type"]
-                text = block["text"]
-                if b_type == "h":
-                    html_content += f"<div class='header-text'>{html.escape(text)}</div>"
-                    continue
-                elif b_type == "li":
-                    html_content += "<div class='list-item'>"
-                else:
-                    html_content += "<div class='p-text'>"
-                for w in text.split():
-                    clean_w = w.strip(".,!?\"'()[]{}:;")
-                    if not clean_w:
-                        html_content += w + " "
-                        continue
-                    unique_id = f"wd{word_counter}_{clean_w}"
-                    html_content += f"<a href='#' id='{unique_id}' class='w'>{html.escape(w)}</a> "
-                    word_counter += 1
-                html_content += "</div>"
-            html_content += "</div>"
-            clicked = click_detector(html_content, key=f"det_{st.session_state.current_screen_index}")
-
-    # --- 右: 辞書リスト ---
-    with col_dict:
-        for i in range(9):
-            slot_data = st.session_state.slots[i] if i < len(st.session_state.slots) else None
-            
-            if slot_data is None:
-                st.markdown(f"<div style='height: 60px; margin-bottom: 4px; border: 1px dashed #f0f0f0; border-radius: 4px;'></div>", unsafe_allow_html=True)
-            else:
-                chunk = slot_data['chunk']
-                info = slot_data['info']
-                st.markdown(f"""
-                <div class="dict-card">
-                    <div class="dict-header">
-                        <span class="dict-word">{chunk}</span>
-                        <span class="dict-pos">{info.get('pos')}</span>
-                    </div>
-                    <div class="dict-pron">{info.get('pronunciation', '')}</div>
-                    <div class="dict-meaning">{info.get('meaning')}</div>
-                </div>
-                """, unsafe_allow_html=True)
-
-    if clicked and clicked != st.session_state.last_clicked:
-        st.session_state.last_clicked = clicked
-        parts = clicked.split("_", 1)
-        if len(parts) == 2:
-            target_word = parts[1]
-            current_blocks = st.session_state.all_screens[st.session_state.current_screen_index]
-            context_text = " ".join([b["text"] for b in current_blocks])
-            
-            result = analyze_chunk_with_gpt(target_word, context_text)
-            original_sentence = result.get('original_sentence', '')
-            
-            client = get_gspread_client()
-            if client:
-                try:
-                    sheet = client.open(st.secrets["sheet_config"]["sheet_name"]).sheet1
-                    meaning_full = f"{result['meaning']} ({result['pos']})"
-                    sheet.append_row([
-                        result['chunk'], 
-                        result.get('pronunciation', ''), 
-                        meaning_full, 
-                        original_sentence, 
-                        st.session_state.pdf_filename
-                    ])
-                except: pass
-            
-            curr = st.session_state.slots
-            curr.pop()
-            curr.insert(0, {"chunk": result["chunk"], "info": result})
-            st.session_state.slots = curr[:9] + [None] * (9 - len(curr))
-            
-            st.rerun()
+    reader_area()
+    
+    if st.session_state.pending_words or st.session_state.lookup_futures:
+        lookup_worker()
+    # 溜まっている行は row_flusher が時間切れで送る (タブを閉じられても失われにくくする)
+    if st.session_state.pending_rows or st.session_state.row_flushes:
+        row_flusher()
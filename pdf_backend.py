@@ -0,0 +1,27 @@
+# PDF テキスト抽出のアダプタ: app.py は extract_page_texts だけを使い、
+# どのライブラリ (PyMuPDF / pypdf) で抽出するかはこのモジュールに閉じ込める
+import io
+
+from pypdf import PdfReader
+
+# PyMuPDF (C実装) があれば優先、無ければ pypdf にフォールバック
+try:
+    import pymupdf
+    _MU_PDF_AVAILABLE = True
+except ImportError:
+    _MU_PDF_AVAILABLE = False
+
+# PyMuPDF は1ページ数msなので直列で十分 (サーバープロセスを fork してまで並列化しない)
+def _extract_with_mupdf(pdf_bytes):
+    with pymupdf.open(stream=pdf_bytes, filetype="pdf") as doc:
+        return [page.get_text("text") for page in doc]
+
+def _extract_with_pypdf(pdf_bytes):
+    reader = PdfReader(io.BytesIO(pdf_bytes))
+    return [page.extract_text() or "" for page in reader.pages]
+
+# --- ページごとのテキスト抽出 (ページ順) ---
+def extract_page_texts(pdf_bytes):
+    if _MU_PDF_AVAILABLE:
+        return _extract_with_mupdf(pdf_bytes)
+    return _extract_with_pypdf(pdf_bytes)